@@ -14,6 +14,8 @@
 # ==============================================================================
 """The SPSA minimization algorithm"""
 import collections
+import functools
+import numbers
 import tensorflow as tf
 import numpy as np
 
@@ -50,7 +52,8 @@ SPSAOptimizerResults = collections.namedtuple(
     [
         'converged',
         # Scalar boolean tensor indicating whether the minimum
-        # was found within tolerance.
+        # was found within tolerance. When searching from a batch
+        # of starting points, this holds one entry per point.
         'num_iterations',
         # The number of iterations of the SPSA update.
         'num_objective_evaluations',
@@ -91,23 +94,45 @@ SPSAOptimizerResults = collections.namedtuple(
     ])
 
 
+def _get_schedules(lr, alpha, perturb, gamma, max_iterations):
+    """Compute the learning rate and perturbation size of every iteration."""
+    lr_init = tf.convert_to_tensor(lr, name='initial_a', dtype='float32')
+    perturb_init = tf.convert_to_tensor(perturb,
+                                        name='initial_c',
+                                        dtype='float32')
+    alpha = tf.convert_to_tensor(alpha, name='alpha', dtype='float32')
+    gamma = tf.convert_to_tensor(gamma, name='gamma', dtype='float32')
+    k = tf.cast(tf.range(max_iterations) + 1, tf.float32)
+    offset = 0.01 * tf.cast(max_iterations, tf.float32)
+    return lr_init / (k + offset)**alpha, perturb_init / k**gamma
+
+
+# Schedules for Python number hyperparameters are reused between eager calls,
+# e.g. when SPSA runs inside an outer optimization loop.
+_get_cached_schedules = functools.lru_cache(maxsize=32)(_get_schedules)
+
+
 def _get_initial_state(initial_position, tolerance, expectation_value_function,
                        lr, alpha, perturb, gamma, blocking, allowed_increase):
     """Create SPSAOptimizerResults with initial state of search."""
+    # Only the position carries the vector dtype, the scalars and objective
+    # values are always kept in float32.
+    dtype = tf.float32
+    batch_shape = prefer_static_shape(initial_position)[:-1]
     init_args = {
-        "converged": tf.Variable(False),
-        "num_iterations": tf.Variable(0),
-        "num_objective_evaluations": tf.Variable(0),
-        "position": tf.Variable(initial_position),
-        "objective_value": tf.Variable(0.),
-        "objective_value_previous_iteration": tf.Variable(np.inf),
+        "converged": tf.fill(batch_shape, False),
+        "num_iterations": tf.constant(0),
+        "num_objective_evaluations": tf.constant(0),
+        "position": initial_position,
+        "objective_value": tf.zeros(batch_shape, dtype=dtype),
+        "objective_value_previous_iteration": tf.fill(batch_shape, np.inf),
         "tolerance": tolerance,
-        "lr": tf.Variable(lr),
-        "alpha": tf.Variable(alpha),
-        "perturb": tf.Variable(perturb),
-        "gamma": tf.Variable(gamma),
-        "blocking": tf.Variable(blocking),
-        "allowed_increase": tf.Variable(allowed_increase)
+        "lr": tf.convert_to_tensor(lr, dtype=dtype),
+        "alpha": tf.convert_to_tensor(alpha, dtype=dtype),
+        "perturb": tf.convert_to_tensor(perturb, dtype=dtype),
+        "gamma": tf.convert_to_tensor(gamma, dtype=dtype),
+        "blocking": tf.convert_to_tensor(blocking, dtype=tf.bool),
+        "allowed_increase": tf.convert_to_tensor(allowed_increase, dtype=dtype)
     }
     return SPSAOptimizerResults(**init_args)
 
@@ -115,6 +140,7 @@ def _get_initial_state(initial_position, tolerance, expectation_value_function,
 def minimize(expectation_value_function,
              initial_position,
              tolerance=1e-5,
+             position_tolerance=None,
              max_iterations=200,
              alpha=0.602,
              lr=1.0,
@@ -123,6 +149,12 @@ def minimize(expectation_value_function,
              blocking=False,
              allowed_increase=0.5,
              seed=None,
+             num_perturbations=1,
+             estimate_objective=False,
+             batch_evaluate_objective=False,
+             sign_estimator=False,
+             jit_compile=False,
+             dtype=tf.float32,
              name=None):
     """Applies the SPSA algorithm.
 
@@ -151,14 +183,23 @@ def minimize(expectation_value_function,
         expectation_value_function:  Python callable that accepts a real
             valued tf.Tensor with shape [n] where n is the number of function
             parameters. The return value is a real `tf.Tensor` Scalar
-            (matching shape `[1]`).
-        initial_position: Real `tf.Tensor` of shape `[n]`. The starting
+            (matching shape `[1]`). See `batch_evaluate_objective` for the
+            batched calling convention.
+        initial_position: Real `tf.Tensor` of shape `[..., n]`. The starting
             point, or points when using batching dimensions, of the search
             procedure. At these points the function value and the gradient
-            norm should be finite.
+            norm should be finite. Batched starting points are searched
+            independently in a single loop, and the search stops once all of
+            them have converged.
         tolerance: Scalar `tf.Tensor` of real dtype. Specifies the tolerance
-            for the procedure. If the supremum norm between two iteration
-            vector is below this number, the algorithm is stopped.
+            for the procedure. If the difference between the objective values
+            of two iterations is below this number, the algorithm is stopped.
+        position_tolerance: (Optional) Scalar `tf.Tensor` of real dtype. If
+            set, the algorithm is instead stopped once the supremum norm of
+            the update between two iteration vectors is below this number.
+            This criterion does not depend on the objective value, so
+            combined with `estimate_objective` no objective evaluation beyond
+            the perturbed ones is needed.
         lr: Scalar `tf.Tensor` of real dtype. Specifies the learning rate
         alpha: Scalar `tf.Tensor` of real dtype. Specifies scaling of the
             learning rate.
@@ -167,12 +208,54 @@ def minimize(expectation_value_function,
         gamma: Scalar `tf.Tensor` of real dtype. Specifies scaling of the
             size of the perturbations.
         blocking: Boolean. If true, then the optimizer will only accept
-            updates that improve the objective function.
+            updates that improve the objective function. Must be a Python
+            `bool` or a constant tensor if `estimate_objective` is set.
         allowed_increase: Scalar `tf.Tensor` of real dtype. Specifies maximum
             allowable increase in objective function (only applies if blocking
             is true).
         seed: (Optional) Python integer. Used to create a random seed for the
-            perturbations.
+            perturbations. If not set, the seed is drawn from the global
+            random number generator.
+        num_perturbations: (Optional) Python integer. The number of random
+            perturbation pairs averaged into each gradient estimate. Larger
+            values reduce the variance of the estimate at the cost of
+            `2 * num_perturbations` objective evaluations per iteration, which
+            are evaluated as a single batch.
+        estimate_objective: (Optional) Python `bool`. If true and `blocking`
+            is false, the objective value tracked for the stopping criterion
+            is estimated as the mean of the perturbed evaluations instead of
+            being evaluated again at the updated position. This saves one
+            objective evaluation per iteration. The returned
+            `objective_value` is still evaluated once at the final
+            position.
+        batch_evaluate_objective: (Optional) Python `bool`. If true,
+            `expectation_value_function` is called once on all the points of
+            an iteration packed into a single tensor of shape `[m, n]` and
+            must return a tensor of shape `[m]`. This lets the two perturbed
+            evaluations run in parallel, e.g. through a single call to a TFQ
+            expectation op. If false, the function is mapped across each
+            point separately.
+        sign_estimator: (Optional) Python `bool`. If true, only the sign of
+            the difference between each pair of perturbed evaluations is
+            used, so every step moves each parameter by `lr` along the
+            perturbation direction (signSPSA). This is more robust to noisy
+            objectives and to small perturbations, since the difference is
+            no longer divided by the perturbation size.
+        jit_compile: (Optional) Python `bool`. If true, each SPSA iteration
+            is traced into a `tf.function` and compiled with XLA, so the
+            perturbation, objective evaluations and update run as a single
+            fused graph. This requires `expectation_value_function` to be
+            `tf.function` compatible and built only from ops that have XLA
+            kernels. The iteration is traced and compiled again on every
+            call, so values captured by `expectation_value_function` are
+            always current.
+        dtype: (Optional) The floating point `tf.DType` used to store the
+            position and the perturbation and update vectors. Reduced
+            precision types such as `tf.bfloat16` halve the memory traffic of
+            these elementwise updates, at the cost of rounding away updates
+            much smaller than the position. Points are cast to `tf.float32`
+            before being passed to `expectation_value_function`, and
+            objective values are always kept in `tf.float32`.
         name: (Optional) Python `str`. The name prefixed to the ops created
             by this function. If not supplied, the default name 'minimize'
             is used.
@@ -182,99 +265,232 @@ def minimize(expectation_value_function,
             result of the optimization process.
     """
 
+    if num_perturbations < 1:
+        raise ValueError("num_perturbations must be greater than zero.")
+
+    if not tf.as_dtype(dtype).is_floating:
+        raise ValueError("dtype must be a floating point type.")
+
+    static_blocking = tf.get_static_value(blocking)
+    if static_blocking is None and estimate_objective:
+        raise ValueError("blocking must be a Python bool or a constant tensor "
+                         "when estimate_objective is set.")
+
     with tf.name_scope(name or 'minimize'):
         if seed is not None:
-            generator = tf.random.Generator.from_seed(seed)
+            seed = tf.constant(seed, dtype=tf.int64, name='seed')
         else:
-            generator = tf.random
-
-        initial_position = tf.convert_to_tensor(initial_position,
-                                                name='initial_position',
-                                                dtype='float32')
-        dtype = initial_position.dtype.base_dtype
+            # Draw a single base seed from the global generator, so the
+            # loop always uses the stateless draws and still follows
+            # `tf.random.set_seed`.
+            seed = tf.random.uniform([],
+                                     maxval=tf.int64.max,
+                                     dtype=tf.int64,
+                                     name='seed')
+
+        initial_position = tf.cast(
+            tf.convert_to_tensor(initial_position, name='initial_position'),
+            dtype)
         tolerance = tf.convert_to_tensor(tolerance,
-                                         dtype=dtype,
+                                         dtype='float32',
                                          name='grad_tolerance')
+        if position_tolerance is not None:
+            stop_tolerance = tf.convert_to_tensor(position_tolerance,
+                                                  dtype=dtype,
+                                                  name='position_tolerance')
+        else:
+            # The objective criterion compares squared differences, which
+            # avoids taking an absolute value every iteration. The sign is
+            # kept so a non-positive tolerance still never converges, and the
+            # squares are taken in float64 so small tolerances do not
+            # underflow to zero.
+            stop_tolerance = tf.cast(tolerance, tf.float64)
+            stop_tolerance = stop_tolerance * tf.abs(stop_tolerance)
+
+        # The learning rate and perturbation size only depend on the
+        # iteration number, so compute their schedules once up front.
+        hyperparameters = (lr, alpha, perturb, gamma, max_iterations)
+        if tf.executing_eagerly() and all(
+                isinstance(x, numbers.Number) for x in hyperparameters):
+            lr_schedule, perturb_schedule = _get_cached_schedules(
+                *hyperparameters)
+        else:
+            lr_schedule, perturb_schedule = _get_schedules(*hyperparameters)
         max_iterations = tf.convert_to_tensor(max_iterations,
                                               name='max_iterations')
 
-        lr_init = tf.convert_to_tensor(lr, name='initial_a', dtype='float32')
-        perturb_init = tf.convert_to_tensor(perturb,
-                                            name='initial_c',
-                                            dtype='float32')
+        def _evaluate(points):
+            """Evaluate the objective on each point of `points`.
+
+            Args:
+                points: A `tf.Tensor` of shape `[..., n]`.
 
-        def _spsa_once(state):
+            Returns:
+                values: A `tf.Tensor` of shape `[...]` holding the objective
+                        value at each point.
+            """
+            shape = prefer_static_shape(points)
+            flat_points = tf.cast(tf.reshape(points, [-1, shape[-1]]),
+                                  tf.float32)
+            num_points = tf.compat.dimension_value(flat_points.shape[0])
+            if batch_evaluate_objective:
+                values = expectation_value_function(flat_points)
+            elif num_points is None:
+
+                def _evaluate_point(point):
+                    """Evaluate one point when the number of points is only
+                    known at run time, e.g. for an unknown batch size."""
+                    return tf.reshape(
+                        tf.cast(expectation_value_function(point), tf.float32),
+                        [])
+
+                values = tf.map_fn(_evaluate_point,
+                                   flat_points,
+                                   fn_output_signature=tf.float32)
+            else:
+                values = tf.stack([
+                    tf.reshape(expectation_value_function(flat_points[i]), [])
+                    for i in range(num_points)
+                ])
+            return tf.reshape(tf.cast(values, tf.float32), shape[:-1])
+
+        def _spsa_once(state, seed, stop_tolerance):
             """Caclulate single SPSA gradient estimation
 
             Args:
                 state: A SPSAOptimizerResults object stores the
                        current state of the minimizer.
+                seed: Scalar `tf.Tensor` of int64 dtype. The base seed of
+                      the perturbations.
+                stop_tolerance: Scalar `tf.Tensor` of real dtype. Either the
+                      position tolerance or the squared objective tolerance.
 
             Returns:
                 states: A list which the first element is the new state
             """
-            delta_shift = tf.cast(
-                2 * generator.uniform(shape=state.position.shape,
-                                      minval=0,
-                                      maxval=2,
-                                      dtype=tf.int32) - 1, tf.float32)
-            v_m = expectation_value_function(state.position -
-                                             state.perturb * delta_shift)
-            v_p = expectation_value_function(state.position +
-                                             state.perturb * delta_shift)
-
-            gradient_estimate = (v_p - v_m) / (2 * state.perturb) * delta_shift
-            update = state.lr * gradient_estimate
-
-            state.num_objective_evaluations.assign_add(2)
-
-            current_obj = expectation_value_function(state.position - update)
-            if state.objective_value_previous_iteration + \
-                state.allowed_increase >= current_obj or not state.blocking:
-                state.position.assign(state.position - update)
-                state.objective_value_previous_iteration.assign(
-                    state.objective_value)
-                state.objective_value.assign(current_obj)
+            perturbation_shape = tf.concat(
+                [[num_perturbations],
+                 prefer_static_shape(state.position)], 0)
+            # Key the draw on the iteration so the loop stays stateless.
+            bits = tf.random.stateless_uniform(
+                perturbation_shape,
+                seed=tf.stack([seed,
+                               tf.cast(state.num_iterations, tf.int64)]),
+                minval=None,
+                maxval=None,
+                dtype=tf.int32)
+            # The sign bit of a random word is a fair coin, so one integer
+            # draw maps straight to the Rademacher perturbation direction.
+            delta = tf.where(bits < 0, tf.constant(-1., dtype),
+                             tf.constant(1., dtype))
+            shift = tf.cast(state.perturb, dtype) * delta
+            values = _evaluate(
+                tf.concat([state.position - shift, state.position + shift], 0))
+            v_m = values[:num_perturbations]
+            v_p = values[num_perturbations:]
+
+            # Average the estimates of all perturbation pairs. The scalar
+            # factors are grouped first so only one elementwise pass over the
+            # position sized tensors remains.
+            if sign_estimator:
+                # Only the sign of each difference is kept, so the step is
+                # lr along the perturbation direction and nothing is divided.
+                difference = tf.sign(v_p - v_m)
+                scale = tf.cast(state.lr, dtype)
+            else:
+                difference = v_p - v_m
+                scale = tf.cast(state.lr / (2. * state.perturb), dtype)
+            update = scale * tf.reduce_mean(
+                tf.cast(difference, dtype)[..., tf.newaxis] * delta, axis=0)
+
+            num_evaluations = 2 * num_perturbations
+            if estimate_objective and not static_blocking:
+                # Nothing needs the exact value at the new position, so reuse
+                # the evaluations around the current one.
+                current_obj = tf.reduce_mean(values, axis=0)
+            else:
+                current_obj = _evaluate(state.position - update)
+                num_evaluations += 1
+
+            state = state._replace(
+                num_objective_evaluations=state.num_objective_evaluations +
+                num_evaluations * tf.size(state.objective_value))
+
+            # Select between the updated and the old state without a Python
+            # branch, so the choice stays on device and traces correctly.
+            # Searches that already converged are left unchanged.
+            accept = tf.logical_and(
+                tf.logical_not(state.converged),
+                tf.logical_or(
+                    tf.logical_not(state.blocking),
+                    state.objective_value_previous_iteration +
+                    state.allowed_increase >= current_obj))
+            state = state._replace(
+                position=tf.where(accept[..., tf.newaxis],
+                                  state.position - update, state.position),
+                objective_value_previous_iteration=tf.where(
+                    accept, state.objective_value,
+                    state.objective_value_previous_iteration),
+                objective_value=tf.where(accept, current_obj,
+                                         state.objective_value))
+
+            if position_tolerance is not None:
+                within_tolerance = tf.reduce_max(tf.abs(update),
+                                                 axis=-1) < stop_tolerance
+            else:
+                within_tolerance = tf.math.squared_difference(
+                    tf.cast(state.objective_value, tf.float64),
+                    tf.cast(state.objective_value_previous_iteration,
+                            tf.float64)) < stop_tolerance
+            state = state._replace(
+                converged=tf.logical_or(state.converged, within_tolerance))
 
             return [state]
 
         # The `state` here is a `SPSAOptimizerResults` tuple with
         # values for the current state of the algorithm computation.
         def _cond(state):
-            """Continue if iterations remain and stopping condition
-            is not met."""
-            return (state.num_iterations < max_iterations) \
-                   and (not state.converged)
+            """Continue if the stopping condition is not met.
 
-        def _body(state):
+            The iteration cap is enforced by `maximum_iterations` of
+            `tf.while_loop`."""
+            return tf.logical_not(tf.reduce_all(state.converged))
+
+        def _body(state, lr_schedule, perturb_schedule, seed, stop_tolerance):
             """Main optimization loop."""
-            new_lr = lr_init / (
-                (tf.cast(state.num_iterations + 1, tf.float32) +
-                 0.01 * tf.cast(max_iterations, tf.float32))**state.alpha)
-            new_perturb = perturb_init / (tf.cast(state.num_iterations + 1,
-                                                  tf.float32)**state.gamma)
-
-            state.lr.assign(new_lr)
-            state.perturb.assign(new_perturb)
-
-            _spsa_once(state)
-            state.num_iterations.assign_add(1)
-            state.converged.assign(
-                tf.abs(state.objective_value -
-                       state.objective_value_previous_iteration) <
-                state.tolerance)
+            new_lr = tf.gather(lr_schedule, state.num_iterations)
+            new_perturb = tf.gather(perturb_schedule, state.num_iterations)
+
+            state = state._replace(lr=new_lr, perturb=new_perturb)
+
+            state = _spsa_once(state, seed, stop_tolerance)[0]
+            state = state._replace(num_iterations=state.num_iterations + 1)
             return [state]
 
+        if jit_compile:
+            _body = tf.function(_body, jit_compile=True)
+
         initial_state = _get_initial_state(initial_position, tolerance,
                                            expectation_value_function, lr,
                                            alpha, perturb, gamma, blocking,
                                            allowed_increase)
 
-        initial_state.objective_value.assign(
-            tf.cast(expectation_value_function(initial_state.position),
-                    tf.float32))
-
-        return tf.while_loop(cond=_cond,
-                             body=_body,
-                             loop_vars=[initial_state],
-                             parallel_iterations=1)[0]
+        initial_state = initial_state._replace(
+            objective_value=_evaluate(initial_state.position))
+
+        final_state = tf.while_loop(
+            cond=_cond,
+            body=lambda state: _body(state, lr_schedule, perturb_schedule, seed,
+                                     stop_tolerance),
+            loop_vars=[initial_state],
+            maximum_iterations=max_iterations,
+            parallel_iterations=1)[0]
+
+        if estimate_objective and not static_blocking:
+            # The tracked value is an estimate around the previous position,
+            # so report the exact value at the returned one.
+            final_state = final_state._replace(
+                objective_value=_evaluate(final_state.position),
+                num_objective_evaluations=final_state.num_objective_evaluations
+                + tf.size(final_state.objective_value))
+        return final_state
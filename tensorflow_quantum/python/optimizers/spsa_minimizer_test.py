@@ -94,7 +94,9 @@ class SPSAMinimizerTest(tf.test.TestCase, parameterized.TestCase):
         """
         func = lambda x: x[0]**2 + x[1]**2
 
-        result = spsa_minimizer.minimize(func, tf.random.uniform(shape=[2]))
+        result = spsa_minimizer.minimize(func,
+                                         tf.random.uniform(shape=[2]),
+                                         seed=1234)
         self.assertAlmostEqual(func(result.position).numpy(), 0, delta=1e-4)
         self.assertTrue(result.converged)
 
@@ -109,6 +111,307 @@ class SPSAMinimizerTest(tf.test.TestCase, parameterized.TestCase):
         self.assertAlmostEqual(func(result.position).numpy(), 0, delta=2e-4)
         self.assertTrue(result.converged)
 
+    def test_non_positive_tolerance(self):
+        """Test that a non-positive tolerance runs all iterations.
+        """
+        n = 10
+        func = lambda x: tf.math.reduce_sum(tf.math.sin(x))
+
+        for tolerance in [0., -1.]:
+            result = spsa_minimizer.minimize(func,
+                                             tf.random.uniform(shape=[n]),
+                                             tolerance=tolerance,
+                                             max_iterations=50,
+                                             seed=1234)
+            self.assertEqual(result.num_iterations, 50)
+            self.assertFalse(result.converged)
+
+    def test_small_tolerance(self):
+        """Test that a tolerance whose square underflows in float32 still
+        stops on an unchanged objective.
+        """
+        func = lambda x: tf.constant(1.)
+
+        result = spsa_minimizer.minimize(func,
+                                         tf.random.uniform(shape=[10]),
+                                         tolerance=1e-30,
+                                         seed=1234)
+        self.assertTrue(result.converged)
+        self.assertEqual(result.num_iterations, 1)
+
+    def test_seed_reproducibility(self):
+        """Test that seeded runs reproduce the same search.
+        """
+        n = 10
+        func = lambda x: tf.math.reduce_sum(tf.math.sin(x))
+        init = tf.random.uniform(shape=[n])
+
+        first = spsa_minimizer.minimize(func, init, seed=1234)
+        second = spsa_minimizer.minimize(func, init, seed=1234)
+        self.assertAllEqual(first.position, second.position)
+        self.assertEqual(first.num_iterations, second.num_iterations)
+
+        # Without a seed the perturbations follow the global seed.
+        tf.random.set_seed(1234)
+        first = spsa_minimizer.minimize(func, init)
+        tf.random.set_seed(1234)
+        second = spsa_minimizer.minimize(func, init)
+        self.assertAllEqual(first.position, second.position)
+
+    def test_schedule_cache(self):
+        """Test that calls with the same Python hyperparameters share the
+        cached schedules.
+        """
+        n = 10
+        func = lambda x: tf.math.reduce_sum(tf.math.sin(x))
+        init = tf.random.uniform(shape=[n])
+
+        expected = spsa_minimizer.minimize(func, init, lr=0.25, seed=1234)
+        info = spsa_minimizer._get_cached_schedules.cache_info()
+        result = spsa_minimizer.minimize(func, init, lr=0.25, seed=1234)
+        new_info = spsa_minimizer._get_cached_schedules.cache_info()
+        self.assertEqual(new_info.hits, info.hits + 1)
+        self.assertEqual(new_info.misses, info.misses)
+        self.assertAllEqual(result.position, expected.position)
+
+    def test_jit_compile_captured_values(self):
+        """Test that the compiled loop follows values captured by the
+        objective, and handles new shapes.
+        """
+        target = tf.constant(1.)
+        func = lambda x: tf.math.reduce_sum((x - target)**2)
+
+        for n, new_target in [(10, 1.), (10, -2.), (5, -2.)]:
+            target = tf.constant(new_target)
+            init = tf.random.uniform(shape=[n])
+            expected = spsa_minimizer.minimize(func, init, lr=0.1, seed=1234)
+            result = spsa_minimizer.minimize(func,
+                                             init,
+                                             lr=0.1,
+                                             seed=1234,
+                                             jit_compile=True)
+            self.assertAllClose(result.position, expected.position, atol=1e-5)
+            self.assertEqual(result.num_iterations, expected.num_iterations)
+
+    def test_estimate_objective_dynamic_blocking(self):
+        """Test that a non-static blocking flag is rejected when the
+        objective is estimated, and accepted when compiling.
+        """
+        n = 10
+        func = lambda x: tf.math.reduce_sum(tf.math.sin(x))
+        init = tf.random.uniform(shape=[n])
+
+        minimize = tf.function(lambda x, blocking: spsa_minimizer.minimize(
+            func, x, blocking=blocking, estimate_objective=True))
+        with self.assertRaisesRegex(ValueError, "blocking must be"):
+            minimize(init, tf.constant(True))
+
+        expected = spsa_minimizer.minimize(func, init, blocking=True, seed=1234)
+        minimize = tf.function(lambda x, blocking: spsa_minimizer.minimize(
+            func, x, blocking=blocking, seed=1234, jit_compile=True))
+        result = minimize(init, tf.constant(True))
+        self.assertAllClose(result.position, expected.position, atol=1e-5)
+
+    @parameterized.named_parameters(
+        ('tensor_hyperparameters', dict(lr=tf.constant(0.5))),
+        ('jit_compile', dict(jit_compile=True)),
+        ('graph_mode', dict(), True),
+        ('batch_evaluate_objective', dict(batch_evaluate_objective=True)),
+    )
+    def test_equivalent_search(self, options, graph_mode=False):
+        """Test that options which only change how each iteration is computed
+        reproduce the default eager search.
+        """
+        n = 10
+        func = lambda x: tf.math.reduce_sum(tf.math.sin(x), axis=-1)
+        init = tf.random.uniform(shape=[n])
+        kwargs = {'lr': 0.5, 'seed': 1234}
+        kwargs.update(options)
+
+        minimize = lambda x: spsa_minimizer.minimize(func, x, **kwargs)
+        if graph_mode:
+            minimize = tf.function(minimize)
+
+        expected = spsa_minimizer.minimize(func, init, lr=0.5, seed=1234)
+        result = minimize(init)
+        self.assertAllClose(result.position, expected.position, atol=1e-5)
+        self.assertEqual(result.num_iterations, expected.num_iterations)
+
+    def test_batch_evaluate_objective(self):
+        """Test that the objective is called once per batch of points.
+        """
+        n = 10
+        num_perturbations = 3
+        shapes = []
+
+        def func(x):
+            shapes.append(x.shape.as_list())
+            return tf.math.reduce_sum(tf.math.sin(x), axis=-1)
+
+        result = spsa_minimizer.minimize(func,
+                                         tf.random.uniform(shape=[n]),
+                                         num_perturbations=num_perturbations,
+                                         batch_evaluate_objective=True,
+                                         seed=1234)
+        # The starting point, then the perturbed points and the updated point
+        # of every iteration.
+        self.assertEqual(
+            shapes, [[1, n]] +
+            [[2 * num_perturbations, n], [1, n]] * int(result.num_iterations))
+
+    def test_multiple_perturbations(self):
+        """Test averaging the gradient estimate over several perturbations.
+        """
+        n = 10
+        num_perturbations = 4
+        func = lambda x: tf.math.reduce_sum(tf.math.sin(x))
+
+        result = spsa_minimizer.minimize(func,
+                                         tf.random.uniform(shape=[n]),
+                                         num_perturbations=num_perturbations)
+        self.assertLessEqual(func(result.position).numpy(), -n + 0.1 * n)
+        self.assertEqual(result.num_objective_evaluations,
+                         (2 * num_perturbations + 1) * result.num_iterations)
+
+        with self.assertRaisesRegex(ValueError, "greater than zero"):
+            spsa_minimizer.minimize(func,
+                                    tf.random.uniform(shape=[n]),
+                                    num_perturbations=0)
+
+    def test_batched_initial_position(self):
+        """Test searching from a batch of starting points at once.
+        """
+        n = 10
+        batch_size = 3
+        func = lambda x: tf.math.reduce_sum(tf.math.sin(x), axis=-1)
+
+        init = tf.random.uniform(shape=[batch_size, n])
+
+        result = spsa_minimizer.minimize(func,
+                                         init,
+                                         batch_evaluate_objective=True)
+        self.assertAllEqual(result.position.shape, [batch_size, n])
+        self.assertAllEqual(result.converged.shape, [batch_size])
+        self.assertTrue(tf.reduce_all(func(result.position) < func(init)))
+        self.assertEqual(result.num_objective_evaluations,
+                         3 * batch_size * result.num_iterations)
+
+    def test_unknown_batch_size(self):
+        """Test mapping the objective over a batch of unknown size.
+        """
+        n = 10
+        func = lambda x: tf.math.reduce_sum(tf.math.sin(x))
+        init = tf.random.uniform(shape=[3, n])
+
+        minimize = tf.function(
+            lambda x: spsa_minimizer.minimize(func, x, seed=1234),
+            input_signature=[tf.TensorSpec([None, n], tf.float32)])
+        expected = spsa_minimizer.minimize(func, init, seed=1234)
+        result = minimize(init)
+        self.assertAllClose(result.position, expected.position, atol=1e-5)
+        self.assertEqual(result.num_iterations, expected.num_iterations)
+
+    def test_estimate_objective(self):
+        """Test skipping the objective evaluation at the updated position.
+        """
+        n = 10
+        func = lambda x: tf.math.reduce_sum(tf.math.sin(x))
+
+        result = spsa_minimizer.minimize(func,
+                                         tf.random.uniform(shape=[n]),
+                                         estimate_objective=True)
+        self.assertLessEqual(func(result.position).numpy(), -n + 0.1 * n)
+        self.assertAllClose(result.objective_value, func(result.position))
+        self.assertEqual(result.num_objective_evaluations,
+                         2 * result.num_iterations + 1)
+
+    def test_position_tolerance(self):
+        """Test stopping on the size of the update instead of the objective.
+        """
+        n = 10
+        func = lambda x: tf.math.reduce_sum(tf.math.sin(x))
+
+        result = spsa_minimizer.minimize(func,
+                                         tf.random.uniform(shape=[n]),
+                                         position_tolerance=1e-5,
+                                         estimate_objective=True,
+                                         max_iterations=1000)
+        self.assertTrue(result.converged)
+        self.assertLessEqual(func(result.position).numpy(), -n + 0.1 * n)
+
+        # A large position tolerance stops on the first small update, even
+        # though the objective still changes by more than `tolerance`.
+        init = tf.random.uniform(shape=[n])
+        result = spsa_minimizer.minimize(func,
+                                         init,
+                                         lr=0.01,
+                                         position_tolerance=1.,
+                                         seed=1234)
+        self.assertTrue(result.converged)
+        self.assertEqual(result.num_iterations, 1)
+        self.assertLess(tf.reduce_max(tf.abs(result.position - init)), 1.)
+        self.assertGreater(
+            tf.abs(result.objective_value -
+                   result.objective_value_previous_iteration), result.tolerance)
+
+    def test_sign_estimator(self):
+        """Test the signSPSA update, which only uses the sign of the
+        difference between the perturbed evaluations.
+        """
+        n = 10
+        func = lambda x: tf.math.reduce_sum(tf.math.sin(x))
+        initial_position = tf.random.uniform(shape=[n])
+
+        result = spsa_minimizer.minimize(func,
+                                         initial_position,
+                                         sign_estimator=True,
+                                         max_iterations=1)
+        lr = 1.0 / (1.0 + 0.01)**0.602
+        self.assertAllClose(tf.abs(result.position - initial_position),
+                            tf.fill([n], lr))
+
+        result = spsa_minimizer.minimize(func,
+                                         tf.random.uniform(shape=[n]),
+                                         sign_estimator=True,
+                                         tolerance=0.,
+                                         max_iterations=1000)
+        self.assertLessEqual(func(result.position).numpy(), -n + 0.1 * n)
+
+        # The update never divides by the perturbation size.
+        result = spsa_minimizer.minimize(func,
+                                         tf.random.uniform(shape=[n]),
+                                         perturb=1e-39,
+                                         sign_estimator=True,
+                                         seed=1234)
+        self.assertTrue(tf.reduce_all(tf.math.is_finite(result.position)))
+
+    def test_small_perturbation(self):
+        """Test that a tiny perturbation does not overflow the update.
+        """
+        n = 10
+        func = lambda x: tf.math.reduce_sum(tf.math.sin(x))
+
+        result = spsa_minimizer.minimize(func,
+                                         tf.random.uniform(shape=[n]),
+                                         perturb=1e-20,
+                                         seed=1234)
+        self.assertTrue(tf.reduce_all(tf.math.is_finite(result.position)))
+
+    def test_bfloat16_position(self):
+        """Test storing the position in reduced precision.
+        """
+        n = 10
+        func = lambda x: tf.math.reduce_sum(tf.math.sin(x))
+        init = tf.random.uniform(shape=[n])
+
+        result = spsa_minimizer.minimize(func, init, dtype=tf.bfloat16)
+        self.assertEqual(result.position.dtype, tf.bfloat16)
+        self.assertEqual(result.objective_value.dtype, tf.float32)
+        self.assertLess(func(tf.cast(result.position, tf.float32)), func(init))
+
+        with self.assertRaisesRegex(ValueError, "floating point"):
+            spsa_minimizer.minimize(func, init, dtype=tf.int32)
+
     def test_noisy_sin_function_optimization(self):
         """Test noisy ssinusoidal function
         """